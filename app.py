@@ -2,11 +2,10 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-import plotly.express as px
-import asyncio
 from datetime import datetime
 import time
-from scipy import stats
+import hashlib
+import io
 import os
 
 from functions import *
@@ -34,10 +33,24 @@ with st.sidebar:
     
     if uploaded_file is not None:
         try:
-            data = pd.read_csv(uploaded_file)
-            data['timestamp'] = pd.to_datetime(data['timestamp'])
-            st.session_state.data = data
-            st.session_state.data_loaded = True
+            file_bytes = uploaded_file.getvalue()
+            data_hash = hashlib.md5(file_bytes).hexdigest()
+            
+            # Перечитываем данные только при загрузке нового файла
+            if st.session_state.get('data_hash') != data_hash:
+                data, city_summary, cities = load_temperature_csv(file_bytes)
+                st.session_state.data = data
+                st.session_state.city_summary = city_summary
+                st.session_state.cities = cities
+                st.session_state.data_hash = data_hash
+                st.session_state.data_loaded = True
+                
+                # Данные по каждому городу, чтобы не фильтровать весь датафрейм при каждом перезапуске
+                st.session_state.city_groups = split_by_city(data)
+                
+                # Результаты анализа предыдущего файла больше не актуальны
+                for key in ['data_with_anomalies', 'seasonal_stats', 'anomalies_by_city', 'season_lookup', 'report_summary']:
+                    st.session_state.pop(key, None)
             st.success(f"✅ Данные загружены!")
         except Exception as e:
             st.error(f"❌ Ошибка при загрузке файла: {e}")
@@ -83,7 +96,7 @@ if st.session_state.data_loaded:
     data = st.session_state.data
     
     # Выбор города
-    cities = sorted(data['city'].unique())
+    cities = st.session_state.cities
     selected_city = st.selectbox(
         "Выберите город для анализа",
         cities,
@@ -106,30 +119,31 @@ if st.session_state.data_loaded:
             # Основная статистика
             col1, col2, col3, col4 = st.columns(4)
             
-            city_data = data[data['city'] == selected_city]
-            current_season = city_data.iloc[-1]['season'] if not city_data.empty else "unknown"
+            city_data = st.session_state.city_groups[selected_city]
+            city_summary = st.session_state.city_summary.loc[selected_city]
+            current_season = city_summary['last_season']
             
             with col1:
                 st.metric(
                     "Всего записей",
-                    f"{len(city_data):,}"
+                    f"{city_summary['rows']:,}"
                 )
             
             with col2:
                 st.metric(
                     "Период",
-                    f"{city_data['timestamp'].min().date()} - {city_data['timestamp'].max().date()}"
+                    f"{city_summary['t_min'].date()} - {city_summary['t_max'].date()}"
                 )
             
             with col3:
-                avg_temp = city_data['temperature'].mean()
+                avg_temp = city_summary['mean']
                 st.metric(
                     "🌡️ Средняя температура",
                     f"{avg_temp:.1f}°C"
                 )
             
             with col4:
-                std_temp = city_data['temperature'].std()
+                std_temp = city_summary['std']
                 st.metric(
                     "Стандартное отклонение",
                     f"{std_temp:.1f}°C"
@@ -137,30 +151,12 @@ if st.session_state.data_loaded:
             
             # Гистограмма распределения температур
             st.subheader("Распределение температур")
-            fig_dist = px.histogram(
-                city_data,
-                x='temperature',
-                nbins=50,
-                title=f'Распределение температур в {selected_city}',
-                color_discrete_sequence=['skyblue']
-            )
-            fig_dist.update_layout(
-                xaxis_title='Температура (°C)',
-                yaxis_title='Частота',
-                height=400
-            )
+            fig_dist = plot_temperature_histogram(city_data, st.session_state.data_hash, selected_city)
             st.plotly_chart(fig_dist, use_container_width=True)
             
             # Коробчатая диаграмма по сезонам
             st.subheader("Температура по сезонам")
-            fig_box = px.box(
-                city_data,
-                x='season',
-                y='temperature',
-                color='season',
-                title=f'Распределение температур по сезонам в {selected_city}'
-            )
-            fig_box.update_layout(height=400)
+            fig_box = plot_seasonal_boxplot(city_data, st.session_state.data_hash, selected_city)
             st.plotly_chart(fig_box, use_container_width=True)
         
         with tab2:
@@ -168,15 +164,10 @@ if st.session_state.data_loaded:
             
             if st.button("Запустить анализ временных рядов", type="primary"):
                 with st.spinner("Выполняется анализ данных..."):
-                    # Измерение времени для последовательного анализа
-                    start_time = time.time()
-                    data_sequential = calculate_moving_average_sequential(data, window_size)
-                    sequential_time = time.time() - start_time
-                    
-                    # Измерение времени для параллельного анализа
-                    start_time = time.time()
-                    data_parallel = calculate_moving_average_parallel(data, window_size)
-                    parallel_time = time.time() - start_time
+                    # Замер времени последовательного и параллельного анализа (кэшируется)
+                    data_parallel, sequential_time, parallel_time = run_moving_average_benchmark(
+                        data, st.session_state.data_hash, window_size
+                    )
                     
                     # Сохранение результатов
                     st.session_state.data_analyzed = data_parallel
@@ -199,15 +190,23 @@ if st.session_state.data_loaded:
                         )
                 
                 # Обнаружение аномалий
-                data_with_anomalies = detect_anomalies(data_parallel, anomaly_threshold)
+                data_with_anomalies = cached_detect_anomalies(
+                    data_parallel, st.session_state.data_hash, window_size, anomaly_threshold
+                )
                 st.session_state.data_with_anomalies = data_with_anomalies
+                st.session_state.analysis_key = (st.session_state.data_hash, window_size, anomaly_threshold)
+                st.session_state.report_summary = st.session_state.city_summary.join(
+                    summarize_anomalies(data_with_anomalies)
+                )
+                st.session_state.anomalies_by_city = split_by_city(data_with_anomalies)
                 
                 # Сезоннаяя статистика
-                seasonal_stats = calculate_seasonal_stats(data_with_anomalies)
+                seasonal_stats = cached_seasonal_stats(data_with_anomalies, st.session_state.data_hash)
                 st.session_state.seasonal_stats = seasonal_stats
+                st.session_state.season_lookup = build_season_lookup(seasonal_stats)
                 
                 # Статистика аномалий
-                anomalies_count = data_with_anomalies[data_with_anomalies['anomaly']].shape[0]
+                anomalies_count = int(np.count_nonzero(data_with_anomalies['anomaly'].to_numpy()))
                 total_count = data_with_anomalies.shape[0]
                 anomaly_percentage = (anomalies_count / total_count * 100) if total_count > 0 else 0
                 
@@ -222,24 +221,27 @@ if st.session_state.data_loaded:
             if 'data_with_anomalies' in st.session_state:
                 # Временной ряд
                 st.subheader("Временной ряд температур")
-                fig_timeseries = plot_temperature_timeseries(
-                    st.session_state.data_with_anomalies,
+                fig_timeseries = cached_timeseries_plot(
+                    st.session_state.anomalies_by_city[selected_city],
+                    st.session_state.analysis_key,
                     selected_city
                 )
                 st.plotly_chart(fig_timeseries, use_container_width=True)
                 
                 # Сезонный профиль
                 st.subheader("Сезонный профиль")
-                fig_seasonal = plot_seasonal_profile(
+                fig_seasonal = cached_seasonal_profile_plot(
                     st.session_state.seasonal_stats,
+                    st.session_state.analysis_key,
                     selected_city
                 )
                 st.plotly_chart(fig_seasonal, use_container_width=True)
                 
                 # Распределение аномалий
                 st.subheader("Распределение аномалий")
-                fig_anomalies = plot_anomaly_distribution(
-                    st.session_state.data_with_anomalies,
+                fig_anomalies = cached_anomaly_distribution_plot(
+                    st.session_state.anomalies_by_city[selected_city],
+                    st.session_state.analysis_key,
                     selected_city
                 )
                 if fig_anomalies:
@@ -254,31 +256,32 @@ if st.session_state.data_loaded:
                 with col1:
                     if st.button("Получить текущую температуру", type="primary"):
                         with st.spinner("Получение данных с OpenWeatherMap..."):
-                            # Синхронный запрос
-                            start_time = time.time()
+                            # Синхронный запрос (мимо кэша: время сравнивается с асинхронным запросом)
+                            start_time = time.perf_counter_ns()
                             sync_result = get_current_temperature_sync(
                                 st.session_state.api_key,
-                                selected_city
+                                selected_city,
+                                use_cache=False
                             )
-                            sync_time = time.time() - start_time
+                            sync_time = (time.perf_counter_ns() - start_time) * 1e-9
                             
                             if sync_result['success']:
                                 st.session_state.current_temp = sync_result
                                 st.session_state.sync_time = sync_time
                                 
-                                # Проверка на аномальность
-                                city_data = data[data['city'] == selected_city]
-                                current_season_data = city_data[city_data['season'] == current_season]
+                                # Проверка на аномальность по заранее посчитанной сезонной статистике
+                                if 'season_lookup' not in st.session_state:
+                                    st.session_state.season_lookup = build_season_lookup(
+                                        cached_seasonal_stats(data, st.session_state.data_hash)
+                                    )
+                                season_row = st.session_state.season_lookup.get((selected_city, current_season))
                                 
-                                if not current_season_data.empty:
-                                    season_mean = current_season_data['temperature'].mean()
-                                    season_std = current_season_data['temperature'].std()
+                                if season_row is not None:
+                                    season_mean = season_row['temperature_mean']
+                                    season_std = season_row['temperature_std']
                                     current_temp = sync_result['temperature']
                                     
-                                    is_anomalous = (
-                                        current_temp > season_mean + 2 * season_std or
-                                        current_temp < season_mean - 2 * season_std
-                                    )
+                                    is_anomalous = abs(current_temp - season_mean) > 2 * season_std
                                     
                                     st.session_state.is_anomalous = is_anomalous
                                     st.session_state.season_stats = {
@@ -297,16 +300,18 @@ if st.session_state.data_loaded:
                 with col2:
                     if st.button("Асинхронный запрос (тест)"):
                         with st.spinner("Тестирую асинхронный запрос..."):
-                            async def test_async():
-                                start_time = time.time()
+                            # Корутина выполняется в фоновом потоке, session_state там недоступен
+                            async def test_async(api_key, city):
+                                start_time = time.perf_counter_ns()
                                 results = await get_multiple_temperatures_async(
-                                    st.session_state.api_key,
-                                    [selected_city]
+                                    api_key,
+                                    [city],
+                                    use_cache=False
                                 )
-                                async_time = time.time() - start_time
+                                async_time = (time.perf_counter_ns() - start_time) * 1e-9
                                 return results[0], async_time
                             
-                            result, async_time = asyncio.run(test_async())
+                            result, async_time = run_async(test_async(st.session_state.api_key, selected_city))
                             
                             if result['success']:
                                 st.session_state.async_time = async_time
@@ -383,6 +388,47 @@ if st.session_state.data_loaded:
                         
                         if 'async_time' in st.session_state:
                             st.info(f"Время асинхронного запроса: {st.session_state.async_time:.3f} сек")
+                
+                # Текущая температура во всех городах одним пакетом асинхронных запросов
+                st.subheader("🌍 Все города")
+                
+                if st.button("Обновить все города"):
+                    with st.spinner("Получение данных для всех городов..."):
+                        start_time = time.perf_counter_ns()
+                        results = fetch_all_temperatures(st.session_state.api_key, cities)
+                        st.session_state.all_cities_time = (time.perf_counter_ns() - start_time) * 1e-9
+                        st.session_state.all_cities_cached = sum(result.get('cached', False) for result in results)
+                        
+                        st.session_state.current_temps = {
+                            result['city']: result for result in results if result['success']
+                        }
+                        
+                        failed = [result for result in results if not result['success']]
+                        if failed:
+                            st.error(f"❌ Ошибка для {len(failed)} городов: {failed[0].get('error')}")
+                
+                if st.session_state.current_temps:
+                    st.dataframe(
+                        pd.DataFrame([
+                            {
+                                'Город': city,
+                                'Температура (°C)': round(result['temperature'], 1),
+                                'Описание': result['description']
+                            }
+                            for city, result in st.session_state.current_temps.items()
+                        ]),
+                        use_container_width=True
+                    )
+                    
+                    if 'all_cities_time' in st.session_state:
+                        cached_count = st.session_state.get('all_cities_cached', 0)
+                        if cached_count == len(cities):
+                            st.info("Данные всех городов взяты из кэша (обновляются раз в 10 минут)")
+                        else:
+                            st.info(
+                                f"Время запроса для всех городов: {st.session_state.all_cities_time:.3f} сек"
+                                + (f" (из кэша: {cached_count})" if cached_count else "")
+                            )
             else:
                 st.warning("Для получения текущей температуры введите API ключ OpenWeatherMap в боковой панели")
         
@@ -437,9 +483,10 @@ if st.session_state.data_loaded:
                 
                 st.info("""
                 **💡 Комментарии о параллельных вычислениях:**
-                - Параллельные вычисления эффективны при большом объеме данных и множестве независимых операций
-                - В данном случае анализ по городам можно выполнять независимо
-                - Накладные расходы на создание процессов оправданы при обработке 10+ городов
+                - Параллельный вариант - одно ядро Numba: города обрабатываются потоками (prange) над общими массивами
+                - Процессы не запускаются и данные не сериализуются (pickle), поэтому выигрыш есть и при нескольких городах
+                - Анализ по городам независим, ускорение ограничено числом городов и ядер CPU
+                - Запуски ядра из разных сессий выполняются по очереди (блокировка `_parallel_kernel_lock`), поэтому одновременные анализы не ускоряют друг друга
                 """)
             else:
                 st.info("Запустите анализ временных рядов для сравнения производительности")
@@ -447,7 +494,7 @@ if st.session_state.data_loaded:
         with tab5:
             st.header("📋 Итоговый отчет")
             
-            if all(key in st.session_state for key in ['data_with_anomalies', 'seasonal_stats']):
+            if all(key in st.session_state for key in ['anomalies_by_city', 'seasonal_stats', 'report_summary']):
                 # Сводная информация
                 st.subheader("Сводная статистика")
                 
@@ -469,18 +516,13 @@ if st.session_state.data_loaded:
                 st.subheader("Ключевые выводы")
                 
                 # Анализ трендов
-                city_data = st.session_state.data_with_anomalies[
-                    st.session_state.data_with_anomalies['city'] == selected_city
-                ]
+                city_data = st.session_state.anomalies_by_city[selected_city]
                 
                 if 'moving_avg' in city_data.columns:
-                    # Вычисление линейного тренда
-                    valid_data = city_data.dropna(subset=['moving_avg'])
-                    if len(valid_data) > 1:
-                        x = np.arange(len(valid_data))
-                        y = valid_data['moving_avg'].values
-                        
-                        slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
+                    # Вычисление линейного тренда (кэшируется для города и параметров анализа)
+                    trend = calculate_trend(city_data, st.session_state.analysis_key, selected_city)
+                    if trend is not None:
+                        slope, intercept, r_value, p_value, std_err = trend
                         
                         col1, col2, col3 = st.columns(3)
                         
@@ -510,7 +552,8 @@ if st.session_state.data_loaded:
                 recommendations = []
                 
                 # Анализ аномалий
-                anomaly_rate = city_data['anomaly'].mean() * 100
+                report_row = st.session_state.report_summary.loc[selected_city]
+                anomaly_rate = report_row['anomaly_rate']
                 if anomaly_rate > 5:
                     recommendations.append(
                         f"⚠️ Высокий уровень аномалий ({anomaly_rate:.1f}%). "
@@ -525,15 +568,19 @@ if st.session_state.data_loaded:
                 if st.button("📥 Экспортировать отчет (CSV)"):
                     report_data = {
                         'Город': [selected_city],
-                        'Период анализа': [f"{city_data['timestamp'].min().date()} - {city_data['timestamp'].max().date()}"],
-                        'Всего записей': [len(city_data)],
-                        'Средняя температура': [f"{city_data['temperature'].mean():.1f}°C"],
-                        'Количество аномалий': [city_data['anomaly'].sum()],
+                        'Период анализа': [f"{report_row['t_min'].date()} - {report_row['t_max'].date()}"],
+                        'Всего записей': [report_row['rows']],
+                        'Средняя температура': [f"{report_row['mean']:.1f}°C"],
+                        'Количество аномалий': [report_row['anomalies_count']],
                         'Процент аномалий': [f"{anomaly_rate:.1f}%"]
                     }
                     
                     report_df = pd.DataFrame(report_data)
-                    csv = report_df.to_csv(index=False).encode('utf-8')
+                    
+                    # Запись CSV сразу в байтовый буфер, без промежуточной строки
+                    buffer = io.BytesIO()
+                    report_df.to_csv(buffer, index=False, encoding='utf-8')
+                    csv = buffer.getvalue()
                     
                     st.download_button(
                         label="💾 Скачать отчет",
@@ -1,186 +1,514 @@
-from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import aiohttp
 import asyncio
+import atexit
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from datetime import datetime
-import multiprocessing as mp
+from scipy import stats
+import numba
+from numba import njit, prange
 
-def process_city_for_parallel(args):
-    """Функция для параллельной обработки одного города"""
-    city_data, window_size = args
-    city_data = city_data.sort_values('timestamp')
-    city_data['moving_avg'] = city_data['temperature'].rolling(window=window_size, center=True).mean()
-    city_data['moving_std'] = city_data['temperature'].rolling(window=window_size, center=True).std()
-    return city_data
+try:
+    from tsdownsample import LTTBDownsampler
+except ImportError:
+    LTTBDownsampler = None
+
+# Параллельное ядро вызывается из потоков сессий Streamlit. Слой workqueue (запасной, когда
+# нет TBB и OpenMP) аварийно завершает процесс при одновременных вызовах, а TBB после вызова
+# не из главного потока зависает при выходе интерпретатора. Поэтому OpenMP - первым в
+# приоритете, а запуски ядра сериализуются блокировкой
+numba.config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+_parallel_kernel_lock = threading.Lock()
+
+# Порядок сезонов в году (категории столбца season)
+SEASON_ORDER = ['winter', 'spring', 'summer', 'autumn']
+
+# Функции для загрузки данных
+def _is_sorted_by_city(data):
+    """Проверка за O(N): коды городов не убывают, время не убывает внутри каждого города"""
+    city_codes = pd.Categorical(data['city']).codes
+    if np.any(city_codes[1:] < city_codes[:-1]):
+        return False
+    timestamps = data['timestamp'].to_numpy()
+    same_city = city_codes[1:] == city_codes[:-1]
+    return not np.any(same_city & (timestamps[1:] < timestamps[:-1]))
+
+def ensure_sorted(data):
+    """Датафрейм, отсортированный по городу и времени (исходный не изменяется)"""
+    if _is_sorted_by_city(data):
+        return data
+    return data.sort_values(['city', 'timestamp'], kind='stable', ignore_index=True)
+
+@st.cache_data(show_spinner=False)
+def load_temperature_csv(file_bytes):
+    """Загрузка CSV с температурными данными, сводкой и списком городов (кэшируется по содержимому файла)"""
+    try:
+        # Многопоточный парсер pyarrow заметно быстрее стандартного
+        data = pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow')
+    except ImportError:
+        data = pd.read_csv(io.BytesIO(file_bytes))
+    data['timestamp'] = pd.to_datetime(data['timestamp'], format='ISO8601', cache=True)
+    data['temperature'] = pd.to_numeric(data['temperature'], downcast='float')
+    data['city'] = data['city'].astype('category')
+    # Упорядоченная категория: группировки и сортировка по сезону идут по целым кодам
+    data['season'] = pd.Categorical(data['season'], categories=SEASON_ORDER, ordered=True)
+    # Год нужен для распределения аномалий по годам - вычисляется один раз
+    data['year'] = data['timestamp'].dt.year.astype('int16')
+    
+    # Строки каждого города идут подряд и по времени - срезы по городу непрерывны в памяти
+    data = ensure_sorted(data)
+    
+    # Сводка для обзора данных, чтобы не пересчитывать ее при каждом перезапуске
+    city_summary = data.groupby('city', observed=True).agg(
+        rows=('temperature', 'size'),
+        t_min=('timestamp', 'min'),
+        t_max=('timestamp', 'max'),
+        mean=('temperature', 'mean'),
+        std=('temperature', 'std'),
+        last_season=('season', 'last')
+    )
+    cities = sorted(data['city'].cat.categories.tolist())
+    
+    return data, city_summary, cities
+
+@njit(cache=True)
+def _rolling_mean_std(x, w, out_mean, out_std):
+    """Центрированные скользящие среднее и стандартное отклонение (ddof=1) за один проход"""
+    n = x.shape[0]
+    out_mean[:] = np.nan
+    out_std[:] = np.nan
+    
+    # Окно сдвигается на одну точку: новое значение добавляется, вышедшее из окна удаляется.
+    # Среднее и сумма квадратов отклонений обновляются по Уэлфорду - без потери точности,
+    # как у разности sum(x^2) - sum(x)^2 / n. Пропуски не учитываются, результат есть
+    # только при полном окне (min_periods = w, как в pandas)
+    shift = (w - 1) // 2
+    mean = 0.0
+    ssqdm = 0.0
+    nobs = 0
+    for i in range(n):
+        value = x[i]
+        if not np.isnan(value):
+            nobs += 1
+            delta = value - mean
+            mean += delta / nobs
+            ssqdm += (nobs - 1) * delta * delta / nobs
+        
+        if i >= w:
+            old = x[i - w]
+            if not np.isnan(old):
+                nobs -= 1
+                if nobs > 0:
+                    delta = old - mean
+                    mean -= delta / nobs
+                    ssqdm -= (nobs + 1) * delta * delta / nobs
+                else:
+                    mean = 0.0
+                    ssqdm = 0.0
+        
+        if nobs == w:
+            out_mean[i - shift] = mean
+            if nobs > 1:
+                out_std[i - shift] = np.sqrt(max(ssqdm / (nobs - 1), 0.0))
+
+@njit(parallel=True, nogil=True, cache=True)
+def _rolling_mean_std_per_city(temps, offsets, w, out_mean, out_std):
+    """Скользящие среднее и стандартное отклонение для каждого города в отдельном потоке"""
+    n_cities = offsets.shape[0] - 1
+    for c in prange(n_cities):
+        start, end = offsets[c], offsets[c + 1]
+        _rolling_mean_std(temps[start:end], w, out_mean[start:end], out_std[start:end])
 
 # Функции для анализа данных
+def _city_offsets(data):
+    """Границы непрерывных отрезков городов в отсортированном по городу датафрейме"""
+    city_codes = pd.Categorical(data['city']).codes
+    n_cities = city_codes.max() + 1 if len(city_codes) else 0
+    return np.searchsorted(city_codes, np.arange(n_cities + 1))
+
+def split_by_city(data):
+    """Разбиение датафрейма на данные городов за один проход (без маски на каждый город)"""
+    positions = data.groupby('city', sort=False, observed=True).indices
+    return {city: data.take(pos).reset_index(drop=True) for city, pos in positions.items()}
+
 def calculate_moving_average_parallel(data, window_size):
     """Вычисление скользящего среднего с использованием параллельных вычислений"""
-    cities = data['city'].unique()
-    args_list = [(data[data['city'] == city], window_size) for city in cities]
+    # Данные каждого города - непрерывный отрезок массива температур.
+    # Мелкая копия: добавляются только новые столбцы, исходные данные не копируются
+    result_data = ensure_sorted(data).copy(deep=False)
+    city_offsets = _city_offsets(result_data)
     
-    with ProcessPoolExecutor(max_workers=min(len(cities), mp.cpu_count())) as executor:
-        results = list(executor.map(process_city_for_parallel, args_list))
+    # Накопление в ядре идет в float64, результат хранится в float32, как и температура
+    temps = result_data['temperature'].to_numpy(np.float32)
+    moving_avg = np.empty(len(temps), dtype=np.float32)
+    moving_std = np.empty(len(temps), dtype=np.float32)
+    with _parallel_kernel_lock:
+        _rolling_mean_std_per_city(temps, city_offsets, window_size, moving_avg, moving_std)
     
-    return pd.concat(results)
+    result_data['moving_avg'] = moving_avg
+    result_data['moving_std'] = moving_std
+    return result_data
 
 def calculate_moving_average_sequential(data, window_size):
     """Вычисление скользящего среднего последовательно"""
-    result_data = data.copy()
+    # Одна сортировка при загрузке вместо масок и сортировки по каждому городу
+    result_data = ensure_sorted(data).copy(deep=False)
     
-    for city in result_data['city'].unique():
-        city_mask = result_data['city'] == city
-        city_data = result_data[city_mask].sort_values('timestamp')
-        
-        result_data.loc[city_mask, 'moving_avg'] = city_data['temperature'].rolling(
-            window=window_size, center=True
-        ).mean().values
-        
-        result_data.loc[city_mask, 'moving_std'] = city_data['temperature'].rolling(
-            window=window_size, center=True
-        ).std().values
+    temps = result_data['temperature'].to_numpy(np.float32)
+    moving_avg = np.empty(len(temps), dtype=np.float32)
+    moving_std = np.empty(len(temps), dtype=np.float32)
+    city_offsets = _city_offsets(result_data)
+    for start, end in zip(city_offsets[:-1], city_offsets[1:]):
+        _rolling_mean_std(temps[start:end], window_size, moving_avg[start:end], moving_std[start:end])
     
+    result_data['moving_avg'] = moving_avg
+    result_data['moving_std'] = moving_std
     return result_data
 
 def detect_anomalies(data, threshold=2):
     """Обнаружение аномалий в температурных данных"""
-    data = data.copy()
+    # Столбец anomaly заменяется целиком, поэтому исходный датафрейм достаточно скопировать поверхностно
+    data = data.copy(deep=False)
     data['anomaly'] = False
     
-    for city in data['city'].unique():
-        city_mask = data['city'] == city
-        city_data = data[city_mask]
-        
-        if 'moving_avg' in city_data.columns and 'moving_std' in city_data.columns:
-            valid_mask = ~city_data['moving_avg'].isna() & ~city_data['moving_std'].isna()
-            
-            # Аномалии: выходят за пределы moving_avg ± threshold * moving_std
-            upper_bound = city_data.loc[valid_mask, 'moving_avg'] + threshold * city_data.loc[valid_mask, 'moving_std']
-            lower_bound = city_data.loc[valid_mask, 'moving_avg'] - threshold * city_data.loc[valid_mask, 'moving_std']
-            
-            is_anomaly = (
-                (city_data.loc[valid_mask, 'temperature'] > upper_bound) |
-                (city_data.loc[valid_mask, 'temperature'] < lower_bound)
-            )
-            
-            data.loc[city_mask & valid_mask, 'anomaly'] = is_anomaly.values
+    if 'moving_avg' in data.columns and 'moving_std' in data.columns:
+        # Скользящие статистики уже посчитаны по каждому городу отдельно,
+        # поэтому проверка выполняется сразу для всего датафрейма.
+        # Аномалии: выходят за пределы moving_avg ± threshold * moving_std, то есть
+        # |temperature - moving_avg| > threshold * moving_std (NaN в начале и конце ряда - не аномалии)
+        deviation = np.abs(data['temperature'].to_numpy() - data['moving_avg'].to_numpy())
+        limit = threshold * data['moving_std'].to_numpy()
+        data['anomaly'] = np.where(np.isnan(limit), False, deviation > limit)
     
     return data
 
 def calculate_seasonal_stats(data):
     """Вычисление сезонной статистики"""
-    seasonal_stats = data.groupby(['city', 'season']).agg({
-        'temperature': ['mean', 'std', 'min', 'max', 'count']
-    }).round(2)
+    # Именованная агрегация сразу дает плоские имена столбцов; округление - при отображении.
+    # Температура хранится в float32, статистика считается и хранится в float64
+    temperature = data['temperature'].astype('float64')
+    seasonal_stats = temperature.groupby([data['city'], data['season']], sort=False, observed=True).agg(
+        temperature_mean='mean',
+        temperature_std='std',
+        temperature_min='min',
+        temperature_max='max',
+        temperature_count='count'
+    )
     
-    seasonal_stats.columns = ['_'.join(col).strip() for col in seasonal_stats.columns.values]
-    seasonal_stats = seasonal_stats.reset_index()
+    return seasonal_stats.reset_index()
+
+@st.cache_data(show_spinner=False)
+def calculate_trend(_city_data, analysis_key, city, max_points=2000):
+    """Линейный тренд скользящего среднего по равномерно прореженному ряду"""
+    y = _city_data['moving_avg'].dropna().to_numpy()
+    if len(y) < 2:
+        return None
     
-    return seasonal_stats
+    # Для направления тренда и R² достаточно ~2000 точек суточного ряда
+    x = np.arange(len(y))
+    step = max(len(y) // max_points, 1)
+    
+    return tuple(stats.linregress(x[::step], y[::step]))
 
-# Функции для работы с API
-def get_current_temperature_sync(api_key, city):
-    """Синхронный запрос текущей температуры через OpenWeatherMap API"""
-    base_url = "http://api.openweathermap.org/data/2.5/weather"
+def summarize_anomalies(data):
+    """Количество и процент аномалий по каждому городу"""
+    anomaly_summary = data.groupby('city', observed=True)['anomaly'].agg(['sum', 'mean'])
+    anomaly_summary.columns = ['anomalies_count', 'anomaly_rate']
+    anomaly_summary['anomaly_rate'] *= 100
+    return anomaly_summary
+
+def build_season_lookup(seasonal_stats):
+    """Словарь (город, сезон) -> средняя температура и стандартное отклонение"""
+    return seasonal_stats.set_index(['city', 'season'])[
+        ['temperature_mean', 'temperature_std']
+    ].to_dict('index')
+
+# Кэшированные обертки для анализа (ключ - хэш данных и параметры анализа)
+@st.cache_data(show_spinner=False)
+def run_moving_average_benchmark(_data, data_hash, window_size):
+    """Последовательный и параллельный расчет скользящего среднего с замером времени"""
+    # Прогрев на небольшом срезе: в замер не должна попасть компиляция Numba
+    warmup_data = _data.head(2 * window_size)
+    calculate_moving_average_sequential(warmup_data, window_size)
+    calculate_moving_average_parallel(warmup_data, window_size)
     
-    params = {
+    start_time = time.perf_counter_ns()
+    calculate_moving_average_sequential(_data, window_size)
+    sequential_time = (time.perf_counter_ns() - start_time) * 1e-9
+    
+    start_time = time.perf_counter_ns()
+    data_parallel = calculate_moving_average_parallel(_data, window_size)
+    parallel_time = (time.perf_counter_ns() - start_time) * 1e-9
+    
+    return data_parallel, sequential_time, parallel_time
+
+@st.cache_data(show_spinner=False)
+def cached_detect_anomalies(_data, data_hash, window_size, anomaly_threshold):
+    """Обнаружение аномалий с кэшированием"""
+    return detect_anomalies(_data, anomaly_threshold)
+
+@st.cache_data(show_spinner=False)
+def cached_seasonal_stats(_data, data_hash):
+    """Сезонная статистика с кэшированием"""
+    return calculate_seasonal_stats(_data)
+
+# Функции для работы с API
+WEATHER_API_URL = "http://api.openweathermap.org/data/2.5/weather"
+
+# Данные OpenWeatherMap обновляются раз в ~10 минут, поэтому повторные запросы в этом интервале не нужны
+WEATHER_CACHE_TTL = 600
+
+# Общий кэш успешных ответов для синхронных и асинхронных запросов: (город, api_key) -> результат
+_temperature_cache = TTLCache(maxsize=256, ttl=WEATHER_CACHE_TTL)
+_temperature_cache_lock = threading.Lock()
+
+def _get_cached_temperature(api_key, city):
+    """Копия закэшированного результата (с написанием города как в запросе) или None"""
+    with _temperature_cache_lock:
+        result = _temperature_cache.get((city.lower(), api_key))
+    if result is None:
+        return None
+    return dict(result, city=city, cached=True)
+
+def _put_cached_temperature(api_key, city, result):
+    """Сохранение успешного результата (ошибки не кэшируются)"""
+    with _temperature_cache_lock:
+        _temperature_cache[(city.lower(), api_key)] = result
+
+# Сессия requests для синхронных запросов: TCP-соединение с API переиспользуется между вызовами
+HTTP_POOL_SIZE = 16
+_http_session = requests.Session()
+_http_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+def _weather_params(api_key, city):
+    """Параметры запроса текущей погоды"""
+    return {
         'q': city,
         'appid': api_key,
         'units': 'metric',
         'lang': 'ru'
     }
+
+def _parse_weather(data, status, city):
+    """Разбор ответа OpenWeatherMap (общий для синхронного и асинхронного запроса)"""
+    if status != 200:
+        return {
+            'success': False,
+            'error': data.get('message', 'Unknown error'),
+            'cod': data.get('cod')
+        }
+    
+    return {
+        'success': True,
+        'city': city,
+        'temperature': data['main']['temp'],
+        'feels_like': data['main']['feels_like'],
+        'humidity': data['main']['humidity'],
+        'pressure': data['main']['pressure'],
+        'description': data['weather'][0]['description'],
+        'icon': data['weather'][0]['icon'],
+        'timestamp': datetime.now()
+    }
+
+def get_current_temperature_sync(api_key, city, use_cache=True):
+    """Синхронный запрос текущей температуры через OpenWeatherMap API (use_cache=False - всегда запрос к API)"""
+    cached = _get_cached_temperature(api_key, city) if use_cache else None
+    if cached is not None:
+        return cached
     
     try:
-        response = requests.get(base_url, params=params, timeout=10)
-        data = response.json()
-        
-        if response.status_code == 200:
-            return {
-                'success': True,
-                'city': city,
-                'temperature': data['main']['temp'],
-                'feels_like': data['main']['feels_like'],
-                'humidity': data['main']['humidity'],
-                'pressure': data['main']['pressure'],
-                'description': data['weather'][0]['description'],
-                'icon': data['weather'][0]['icon'],
-                'timestamp': datetime.now()
-            }
-        else:
-            return {
-                'success': False,
-                'error': data.get('message', 'Unknown error'),
-                'cod': data.get('cod')
-            }
+        response = _http_session.get(WEATHER_API_URL, params=_weather_params(api_key, city), timeout=10)
+        result = _parse_weather(response.json(), response.status_code, city)
     except Exception as e:
         return {
             'success': False,
             'error': str(e)
         }
+    
+    if result['success']:
+        _put_cached_temperature(api_key, city, result)
+    return dict(result)
 
-async def get_current_temperature_async(session, api_key, city):
-    """Асинхронный запрос текущей температуры"""
-    base_url = "http://api.openweathermap.org/data/2.5/weather"
+def get_multiple_temperatures_threaded(api_key, cities):
+    """Синхронные запросы температуры для нескольких городов в пуле потоков"""
+    # Ожидание ответа сети не держит GIL; потоков не больше, чем соединений в пуле сессии
+    if not cities:
+        return []
+    with ThreadPoolExecutor(max_workers=min(HTTP_POOL_SIZE, len(cities))) as executor:
+        return list(executor.map(lambda city: get_current_temperature_sync(api_key, city), cities))
+
+# Фоновый цикл событий с общей HTTP-сессией: соединения с API (TCP keep-alive)
+# переиспользуются между запросами вместо новой сессии на каждый asyncio.run
+_loop = None
+_loop_lock = threading.Lock()
+_session = None
+
+def _get_loop():
+    """Цикл событий в отдельном потоке (создается при первом обращении)"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+def _new_session():
+    """HTTP-сессия с пулом соединений для текущего цикла событий"""
+    connector = aiohttp.TCPConnector(limit=50, ttl_dns_cache=300, keepalive_timeout=60)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=10)
+    )
+
+def _on_background_loop():
+    """Выполняется ли текущая корутина в фоновом цикле событий"""
+    return asyncio.get_running_loop() is _loop
+
+async def get_session():
+    """Общая HTTP-сессия фонового цикла событий (доступна только внутри run_async)"""
+    global _session
+    # Сессия aiohttp привязана к циклу, в котором создана: в другом цикле (например,
+    # asyncio.run) она перестанет работать после его закрытия
+    if not _on_background_loop():
+        raise RuntimeError("Общая HTTP-сессия доступна только в фоновом цикле событий (run_async)")
+    if _session is None or _session.closed:
+        _session = _new_session()
+    return _session
+
+def run_async(coro):
+    """Выполнение корутины в фоновом цикле событий и ожидание результата"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+def _close_session():
+    """Закрытие общей HTTP-сессии при завершении приложения"""
+    if _session is not None and not _session.closed:
+        run_async(_session.close())
+
+atexit.register(_close_session)
+
+async def get_current_temperature_async(api_key, city, session=None, use_cache=True):
+    """Асинхронный запрос текущей температуры (по умолчанию через общую сессию)"""
+    cached = _get_cached_temperature(api_key, city) if use_cache else None
+    if cached is not None:
+        return cached
     
-    params = {
-        'q': city,
-        'appid': api_key,
-        'units': 'metric',
-        'lang': 'ru'
-    }
+    # Вне фонового цикла общая сессия недоступна - используется временная
+    if session is None and not _on_background_loop():
+        async with _new_session() as session:
+            return await get_current_temperature_async(api_key, city, session, use_cache)
     
     try:
-        async with session.get(base_url, params=params, timeout=10) as response:
-            data = await response.json()
-            
-            if response.status == 200:
-                return {
-                    'success': True,
-                    'city': city,
-                    'temperature': data['main']['temp'],
-                    'feels_like': data['main']['feels_like'],
-                    'humidity': data['main']['humidity'],
-                    'pressure': data['main']['pressure'],
-                    'description': data['weather'][0]['description'],
-                    'icon': data['weather'][0]['icon'],
-                    'timestamp': datetime.now()
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': data.get('message', 'Unknown error'),
-                    'cod': data.get('cod')
-                }
+        if session is None:
+            session = await get_session()
+        
+        async with session.get(WEATHER_API_URL, params=_weather_params(api_key, city)) as response:
+            result = _parse_weather(await response.json(), response.status, city)
     except Exception as e:
         return {
             'success': False,
             'error': str(e)
         }
+    
+    if result['success']:
+        _put_cached_temperature(api_key, city, result)
+    return dict(result)
 
-async def get_multiple_temperatures_async(api_key, cities):
+async def get_multiple_temperatures_async(api_key, cities, session=None, use_cache=True):
     """Асинхронный запрос температуры для нескольких городов"""
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for city in cities:
-            task = get_current_temperature_async(session, api_key, city)
-            tasks.append(task)
-        
-        results = await asyncio.gather(*tasks)
-        return results
+    # Общая сессия с пулом соединений: запросы идут одновременно, время ~ max(RTT).
+    # Вне фонового цикла - одна временная сессия на все города
+    if session is None and not _on_background_loop():
+        async with _new_session() as session:
+            return await get_multiple_temperatures_async(api_key, cities, session, use_cache)
+    if session is None:
+        session = await get_session()
+    
+    tasks = []
+    for city in cities:
+        task = get_current_temperature_async(api_key, city, session, use_cache)
+        tasks.append(task)
+    
+    results = await asyncio.gather(*tasks)
+    return results
+
+def fetch_all_temperatures(api_key, cities):
+    """Текущая температура для всех городов (успешные ответы берутся из общего кэша)"""
+    return run_async(get_multiple_temperatures_async(api_key, cities))
 
 # Функции для визуализации
-def plot_temperature_timeseries(data, city):
-    """Построение временного ряда температур"""
-    city_data = data[data['city'] == city].sort_values('timestamp')
+def _lttb_indices(x, y, n_out):
+    """Индексы точек, выбранных алгоритмом LTTB (реализация на NumPy)"""
+    n = len(x)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        
+        # Средняя точка следующей корзины (для последней корзины - последняя точка ряда)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        
+        # Точка корзины, образующая треугольник наибольшей площади
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
     
+    return indices
+
+def lttb_downsample(ts, ys, n_out=1500):
+    """Прореживание временного ряда методом LTTB с сохранением формы графика"""
+    if len(ts) <= n_out:
+        return ts, ys
+    
+    x = ts.astype('datetime64[ns]').astype(np.int64) if np.issubdtype(ts.dtype, np.datetime64) else ts
+    y = ys.astype(np.float64)
+    
+    if LTTBDownsampler is not None:
+        indices = LTTBDownsampler().downsample(x, y, n_out=n_out)
+    else:
+        indices = _lttb_indices(x.astype(np.float64), y, n_out)
+    
+    return ts[indices], ys[indices]
+
+def _city_rows(data, city):
+    """Строки города по времени: датафрейм только этого города возвращается без фильтрации"""
+    mask = (data['city'] == city).to_numpy()
+    if not mask.all():
+        data = data[mask]
+    return ensure_sorted(data)
+
+def plot_temperature_timeseries(data, city):
+    """Построение временного ряда температур (data - весь датафрейм или данные одного города)"""
+    city_data = _city_rows(data, city)
     fig = go.Figure()
+    timestamps = city_data['timestamp'].to_numpy()
+    temperatures = city_data['temperature'].to_numpy()
     
-    # Основной временной ряд
-    fig.add_trace(go.Scatter(
-        x=city_data['timestamp'],
-        y=city_data['temperature'],
+    # Основной временной ряд (прореженный, WebGL для быстрой отрисовки)
+    ts, temps = lttb_downsample(timestamps, temperatures)
+    fig.add_trace(go.Scattergl(
+        x=ts,
+        y=temps,
         mode='lines',
         name='Температура',
         line=dict(color='lightblue', width=1),
@@ -189,9 +517,14 @@ def plot_temperature_timeseries(data, city):
     
     # Скользящее среднее
     if 'moving_avg' in city_data.columns:
-        fig.add_trace(go.Scatter(
-            x=city_data['timestamp'],
-            y=city_data['moving_avg'],
+        valid = city_data['moving_avg'].notna().to_numpy()
+        ts, moving_avg = lttb_downsample(
+            timestamps[valid],
+            city_data['moving_avg'].to_numpy()[valid]
+        )
+        fig.add_trace(go.Scattergl(
+            x=ts,
+            y=moving_avg,
             mode='lines',
             name='Скользящее среднее (30 дней)',
             line=dict(color='red', width=2)
@@ -199,11 +532,15 @@ def plot_temperature_timeseries(data, city):
     
     # Аномалии
     if 'anomaly' in city_data.columns:
-        anomalies = city_data[city_data['anomaly']]
-        if not anomalies.empty:
-            fig.add_trace(go.Scatter(
-                x=anomalies['timestamp'],
-                y=anomalies['temperature'],
+        # Маска по массивам столбцов - без промежуточного датафрейма аномальных строк
+        anomaly = city_data['anomaly'].to_numpy()
+        n_anomalies = np.count_nonzero(anomaly)
+        if n_anomalies:
+            # Немного маркеров дешевле рисовать в SVG, тысячи (низкий порог) - через WebGL
+            scatter = go.Scattergl if n_anomalies > 1000 else go.Scatter
+            fig.add_trace(scatter(
+                x=timestamps[anomaly],
+                y=temperatures[anomaly],
                 mode='markers',
                 name='Аномалии',
                 marker=dict(
@@ -224,46 +561,88 @@ def plot_temperature_timeseries(data, city):
     
     return fig
 
+@st.cache_data(show_spinner=False)
+def plot_temperature_histogram(_city_data, data_hash, city, bins=50):
+    """Гистограмма температур (интервалы считаются на сервере, в браузер уходят только столбцы)"""
+    counts, edges = np.histogram(_city_data['temperature'].to_numpy(), bins=bins)
+    
+    fig = go.Figure(go.Bar(
+        x=(edges[:-1] + edges[1:]) / 2,
+        y=counts,
+        width=np.diff(edges),
+        marker_color='skyblue'
+    ))
+    
+    fig.update_layout(
+        title=f'Распределение температур в {city}',
+        xaxis_title='Температура (°C)',
+        yaxis_title='Частота',
+        bargap=0,
+        height=400
+    )
+    
+    return fig
+
+@st.cache_data(show_spinner=False)
+def plot_seasonal_boxplot(_city_data, data_hash, city):
+    """Коробчатая диаграмма по сезонам из заранее посчитанных квартилей"""
+    fig = go.Figure()
+    
+    all_temps = _city_data['temperature'].to_numpy()
+    season_codes = _city_data['season'].cat.codes.to_numpy()
+    
+    for code, season in enumerate(SEASON_ORDER):
+        temps = all_temps[season_codes == code]
+        if len(temps) == 0:
+            continue
+        
+        q1, median, q3 = np.percentile(temps, [25, 50, 75])
+        iqr = q3 - q1
+        
+        # Усы - крайние значения в пределах 1.5 IQR, как у px.box
+        lowerfence = temps[temps >= q1 - 1.5 * iqr].min()
+        upperfence = temps[temps <= q3 + 1.5 * iqr].max()
+        
+        fig.add_trace(go.Box(
+            name=season,
+            x=[season],
+            q1=[q1],
+            median=[median],
+            q3=[q3],
+            lowerfence=[lowerfence],
+            upperfence=[upperfence]
+        ))
+    
+    fig.update_layout(
+        title=f'Распределение температур по сезонам в {city}',
+        xaxis_title='season',
+        yaxis_title='temperature',
+        height=400
+    )
+    
+    return fig
+
 def plot_seasonal_profile(seasonal_stats, city):
     """Построение сезонного профиля"""
-    city_stats = seasonal_stats[seasonal_stats['city'] == city]
+    # Сезоны - упорядоченная категория, сортировка идет в порядке года
+    city_stats = seasonal_stats[seasonal_stats['city'] == city].sort_values('season')
     
     fig = go.Figure()
     
-    # Определение порядка сезонов
-    season_order = ['winter', 'spring', 'summer', 'autumn']
-    city_stats['season'] = pd.Categorical(city_stats['season'], categories=season_order, ordered=True)
-    city_stats = city_stats.sort_values('season')
-    
-    # Средние температуры
+    # Средние температуры с ±1 стандартным отклонением (планки погрешностей одной трассой)
     fig.add_trace(go.Bar(
         x=city_stats['season'],
         y=city_stats['temperature_mean'],
-        name='Средняя температура',
+        name='Средняя температура ±1 стандартное отклонение',
         marker_color='skyblue',
         text=city_stats['temperature_mean'].round(1),
-        textposition='auto'
-    ))
-    
-    # Ошибки (стандартное отклонение)
-    fig.add_trace(go.Scatter(
-        x=city_stats['season'],
-        y=city_stats['temperature_mean'] + city_stats['temperature_std'],
-        mode='lines',
-        line=dict(width=0),
-        showlegend=False,
-        hoverinfo='skip'
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=city_stats['season'],
-        y=city_stats['temperature_mean'] - city_stats['temperature_std'],
-        mode='lines',
-        line=dict(width=0),
-        fill='tonexty',
-        fillcolor='rgba(135, 206, 235, 0.3)',
-        name='±1 стандартное отклонение',
-        hoverinfo='skip'
+        textposition='auto',
+        error_y=dict(
+            type='data',
+            array=city_stats['temperature_std'],
+            visible=True,
+            color='rgba(70, 130, 180, 0.8)'
+        )
     ))
     
     fig.update_layout(
@@ -277,16 +656,17 @@ def plot_seasonal_profile(seasonal_stats, city):
     return fig
 
 def plot_anomaly_distribution(data, city):
-    """Распределение аномалий по годам"""
-    city_data = data[data['city'] == city].copy()
-    city_data['year'] = city_data['timestamp'].dt.year
-    
-    if 'anomaly' not in city_data.columns:
+    """Распределение аномалий по годам (data - весь датафрейм или данные одного города)"""
+    if 'anomaly' not in data.columns:
         return None
+    city_data = _city_rows(data, city)
     
-    anomaly_counts = city_data[city_data['anomaly']].groupby('year').size()
-    total_counts = city_data.groupby('year').size()
-    anomaly_percentages = (anomaly_counts / total_counts * 100).fillna(0)
+    # Доля аномальных дней по годам - одна группировка вместо двух подсчетов
+    if 'year' in city_data.columns:
+        year = city_data['year']
+    else:
+        year = city_data['timestamp'].dt.year.astype('int16')
+    anomaly_percentages = city_data['anomaly'].groupby(year, sort=True).mean() * 100
     
     fig = go.Figure(data=[
         go.Bar(
@@ -307,3 +687,19 @@ def plot_anomaly_distribution(data, city):
     )
     
     return fig
+
+# Кэшированные графики (ключ - параметры, с которыми получены данные анализа, и город)
+@st.cache_data(show_spinner=False)
+def cached_timeseries_plot(_city_data, analysis_key, city):
+    """Временной ряд температур с кэшированием"""
+    return plot_temperature_timeseries(_city_data, city)
+
+@st.cache_data(show_spinner=False)
+def cached_seasonal_profile_plot(_seasonal_stats, analysis_key, city):
+    """Сезонный профиль с кэшированием"""
+    return plot_seasonal_profile(_seasonal_stats, city)
+
+@st.cache_data(show_spinner=False)
+def cached_anomaly_distribution_plot(_city_data, analysis_key, city):
+    """Распределение аномалий по годам с кэшированием"""
+    return plot_anomaly_distribution(_city_data, city)